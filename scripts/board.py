@@ -56,17 +56,62 @@ REQUIREMENTS:
 @author: Eduardo Munoz
 @email: edmugu@protonmail.com
 """
-# from pymata4 import pymata4
-from pyfirmata import Arduino, util
 from statistics import median
-
-# from my_pid import PID
-from simple_pid import PID
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import fire
 import time
+import sys
+import atexit
+
+
+# PID gains (kp, ki, kd) used by set_vload. For reference the Ziegler-Nichols
+# tuning with ku=0.2 and tu=0.33 would be (0.12, 0.727, 0.00495).
+_PID_KP, _PID_KI, _PID_KD = 0.05, 0.3, 0.0
+
+
+def pid_step(kp, ki, kd, setpoint, last_input, integral, dt, measurement, lo, hi):
+    """
+    It does one update of the PID and returns the output and the new integral term.
+    It matches simple_pid.PID with sample_time=None: the integral is clamped to
+    the output limits and the derivative is taken on the measurement to avoid
+    kicks when the setpoint changes. Unlike simple_pid's default sample_time of
+    0.01 it updates on every call instead of holding the output.
+    """
+    if dt <= 0:
+        dt = 1e-16
+    error = setpoint - measurement
+    integral += ki * error * dt
+    if integral < lo:
+        integral = lo
+    elif integral > hi:
+        integral = hi
+    output = kp * error + integral - kd * (measurement - last_input) / dt
+    if output < lo:
+        output = lo
+    elif output > hi:
+        output = hi
+    return output, integral
+
+
+class Voltages(object):
+    """
+    The median voltages of one read_voltages call
+    """
+
+    __slots__ = ("vload", "vin", "t")
+
+    def __init__(self, vload=0.0, vin=0.0, t=0.0):
+        self.vload = vload
+        self.vin = vin
+        self.t = t  # time of the last read, see Board.time
+
+    def __repr__(self):
+        return "Voltages(vload=%5.3f, vin=%5.3f, t=%5.3f)" % (
+            self.vload,
+            self.vin,
+            self.t,
+        )
 
 
 class Board(object):
@@ -85,110 +130,229 @@ class Board(object):
         resistance=10,
         gate_thresh=0.48,  # the gate threshold of the MOSFET
         vcc=5,
+        sampling_interval=2,  # how often firmata reports the analog pins in ms
+        pid_gains=(_PID_KP, _PID_KI, _PID_KD),
     ):
-        # self.board = pymata4.Pymata4()
-        self.board = Arduino(port)
-        self.board.digital[13].write(1)
+        # the arduino is only connected to when it is first needed (see board)
+        self.port = port
+        self._board = None
+        self.it = None
+        self._pin_vload = None
+        self._pin_vin = None
+        self.vout = None
 
         self.pin_vset = pin_vset
         self.pin_vload = pin_vload
         self.pin_vin = pin_vin
         self.vcc = vcc
-        self.gate_thresh = 0.48
+        self.gate_thresh = gate_thresh
         self.amp_gain = amp_gain
         self.resistance = resistance
         self.sense_voltage_divider = sense_voltage_divider
+        # firmata runs at 57600 baud and each analog report is 3 bytes, 30 bits on
+        # the wire with start/stop bits. Two pins need 60 bits per interval:
+        # 60 kbit/s at 1 ms overflows the link, 30 kbit/s at 2 ms leaves half free
+        # the interval is sent as two 7 bit bytes, so at most 16383 ms
+        s = "The sampling interval should be a whole number of ms from 1 to 16383!"
+        if type(sampling_interval) is not int or not 1 <= sampling_interval <= 0x3FFF:
+            raise ValueError(s)
+        self.sampling_interval = sampling_interval
 
         self.pin_voltage_value = 0  # this value is from 0 to 0x4000
         self.value_to_voltage = 5.2 * self.sense_voltage_divider
-        self.voltages = {}
-        self.voltages_history = {"time": [], "vload": [], "vin": []}
+        # gain from the firmata value to volts for each channel (vload, vin)
+        # so each channel can get its own calibration
+        self._gains = (self.value_to_voltage, self.value_to_voltage)
+        self.voltages = Voltages()
+        # history of every read, grown by doubling. The voltages come from a
+        # 10 bit adc so float32 is plenty, the time stays float64
+        self._hist_time = np.empty(1024, dtype=np.float64)
+        self._hist_volts = np.empty((1024, 2), dtype=np.float32)  # (vload, vin)
+        self._hist_n = 0
         self.time_created = time.time()
+        self._t0_ns = time.perf_counter_ns()  # monotonic, unlike time.time()
 
-        self.it = util.Iterator(self.board)
-        self.it.start()
-        self.analog_pins = {"vload": self.pin_vload, "vin": self.pin_vin}
-        self.board.analog[pin_vin].enable_reporting()
-        self.board.analog[pin_vload].enable_reporting()
-        self.vout = self.board.get_pin("d:5:p")
+        s = "The PID gains should be three numbers: kp, ki, kd!"
+        try:
+            pid_tunings = tuple(float(g) for g in pid_gains)
+        except (TypeError, ValueError):
+            raise ValueError(s)
+        if len(pid_tunings) != 3:
+            raise ValueError(s)
+        self.pid_tunings = pid_tunings
+        self._pid_limits = (0.0, 1.0 - self.gate_thresh)
+        self.pid_setpoint = 0
+
+    @property
+    def board(self):
+        """
+        returns the arduino, connecting to it the first time
+        """
+        self._ensure_connected()
+        return self._board
+
+    def _ensure_connected(self):
+        """
+        It connects to the arduino if that has not been done yet
+        """
+        if self._board is None:
+            self._connect()
+
+    def _connect(self):
+        """
+        It opens the serial port to the arduino and sets up the pins
+        """
+        # imported here so the CLI help and Board() do not load the serial stack
+        # from pymata4 import pymata4
+        from pyfirmata import Arduino, util, SAMPLING_INTERVAL
+
+        if sys.platform == "win32":
+            # windows rounds sleeps up to the 15.6 ms timer tick by default,
+            # ask for 1 ms so the waits in read_voltages are what they say
+            import ctypes
+
+            ctypes.windll.winmm.timeBeginPeriod(1)
+            atexit.register(ctypes.windll.winmm.timeEndPeriod, 1)
 
-        self.pid = PID(0.0, 0.0, 0.0, 0)
+        # board = pymata4.Pymata4()
+        board = Arduino(self.port)
+        board.digital[13].write(1)
 
-    def read_voltages(self, times_to_read=5, wait_time_between_reads=0.001):
+        self.it = util.Iterator(board)
+        self.it.start()
+        # firmata reports every 19 ms by default, reads faster than that are repeats
+        board.send_sysex(SAMPLING_INTERVAL, util.to_two_bytes(self.sampling_interval))
+        board.analog[self.pin_vin].enable_reporting()
+        board.analog[self.pin_vload].enable_reporting()
+        # the iterator thread keeps pin.value updated, so it can be read directly
+        self._pin_vload = board.analog[self.pin_vload]
+        self._pin_vin = board.analog[self.pin_vin]
+        self.vout = board.get_pin("d:5:p")
+        self._board = board
+
+    def read_voltages(self, times_to_read=5, wait_time_between_reads=None):
         """
         It reads the voltages on the board multiple times because sometimes firmata returns 0 or none
+
+        :param times_to_read: how many samples to take the median of
+        :param wait_time_between_reads: seconds between samples
+                                        (defaults to the sampling interval)
         """
+        if wait_time_between_reads is None:
+            wait_time_between_reads = self.sampling_interval / 1000
         if times_to_read <= 0 or wait_time_between_reads <= 0:
             raise ValueError("Bad arguments")
+        self._ensure_connected()
+
+        # local names so the loop below does not look up attributes
+        pin_vload = self._pin_vload
+        pin_vin = self._pin_vin
+        gain_vload, gain_vin = self._gains
+        now = self.time
+        sleep = time.sleep
 
-        measurements = {"time": [], "vload": [], "vin": []}
+        # for a handful of samples plain lists are cheaper than numpy arrays
+        times, vloads, vins = [], [], []
         for _ in range(times_to_read):
-            for pin_name, pin in self.analog_pins.items():
-                value = self.board.analog[pin].read()
-                if value is None:
-                    value = 0
-                value = value * self.value_to_voltage
-                measurements[pin_name].append(value)
-                self.voltages_history[pin_name].append(value)
-
-            tmeas = self.time()
-            measurements["time"].append(tmeas)
-            self.voltages_history["time"].append(tmeas)
-            time.sleep(wait_time_between_reads)
-
-        med = {}
-        for pin_name, pin in self.analog_pins.items():
-            med[pin_name] = median(measurements[pin_name])
+            # firmata returns the pin value normalized from 0 to 1 (or None)
+            vloads.append((pin_vload.value or 0) * gain_vload)
+            vins.append((pin_vin.value or 0) * gain_vin)
+            times.append(now())
+            sleep(wait_time_between_reads)
 
+        self._push_history(times, vloads, vins)
+
+        med = Voltages(median(vloads), median(vins), times[-1])
         self.voltages = med
 
         return med
 
+    def _push_history(self, times, vloads, vins):
+        """
+        It appends a batch of reads to the voltages history
+        """
+        n = self._hist_n
+        end = n + len(times)
+        if end > len(self._hist_time):
+            size = max(2 * len(self._hist_time), end)
+            hist_time = np.empty(size, dtype=self._hist_time.dtype)
+            hist_volts = np.empty((size, 2), dtype=self._hist_volts.dtype)
+            hist_time[:n] = self._hist_time[:n]
+            hist_volts[:n] = self._hist_volts[:n]
+            self._hist_time = hist_time
+            self._hist_volts = hist_volts
+        self._hist_time[n:end] = times
+        self._hist_volts[n:end, 0] = vloads
+        self._hist_volts[n:end, 1] = vins
+        self._hist_n = end
+
+    @property
+    def voltages_history(self):
+        """
+        returns the voltages recorded through the whole process
+        """
+        n = self._hist_n
+        return pd.DataFrame(
+            {
+                "time": self._hist_time[:n],
+                "vload": self._hist_volts[:n, 0],
+                "vin": self._hist_volts[:n, 1],
+            }
+        )
+
     def time(self):
         """
         returns the time in respect with the time this was created
         """
-        return time.time() - self.time_created
+        return (time.perf_counter_ns() - self._t0_ns) * 1e-9
 
-    def set_vload(self, voltage, max_tries=10, time_per_try=0.001, verbose=False):
+    def set_vload(
+        self, voltage, max_tries=10, time_per_try=0.001, tolerance=None, verbose=False
+    ):
         """
         It sets the voltage on the power resistor. It does that with the help of a PID
 
         :param voltage: voltage to set
         :param max_tries: how many times the PID can adjust the voltage before exiting
         :param time_per_try: how much to wait before re adjusting the voltage
+        :param tolerance: stop early once vload is this close to voltage
+                          (defaults to one adc step)
         :param verbose: print as much info as possible
         """
         if verbose:
             print("Setting voltage to %5.3f volts." % voltage)
 
-        # ziegler-Nichols tunning
-        ku = 0.2
-        tu = 0.33
-        kp = 0.6 * ku
-        ki = 1.2 * ku / tu
-        kd = 3 * ku * tu / 40
-
-        # self.pid = PID(kp, ki, kd, voltage)
-        self.pid = PID(0.05, 0.3, 0.00, voltage)
-        self.pid.output_limits = (0, 1 - self.gate_thresh)
+        self.pid_setpoint = voltage
+        kp, ki, kd = self.pid_tunings
+        lo, hi = self._pid_limits
+        integral = 0.0
+        last_vload = None
+        tlast = time.perf_counter_ns()
+        if tolerance is None:
+            tolerance = self.value_to_voltage / 1023
 
         tries_count = 0
-        time_history = []
         while tries_count < max_tries:
             tries_count += 1
             self.read_voltages()
-            vload = self.voltages["vload"]
-            time_history.append(self.time())
-            output = self.pid(vload)
+            vload = self.voltages.vload
+            if abs(vload - voltage) <= tolerance:
+                break
+            tnow = time.perf_counter_ns()
+            dt = (tnow - tlast) * 1e-9
+            if last_vload is None:
+                last_vload = vload
+            output, integral = pid_step(
+                kp, ki, kd, voltage, last_vload, integral, dt, vload, lo, hi
+            )
+            last_vload = vload
+            tlast = tnow
             output += self.gate_thresh
             self.vout.write(output)
 
             if verbose:
-                print("\n")
-                print("time: %5.3f" % self.time())
-                print("pid output: %5.3f" % output)
-                print(str(self.voltages))
+                t = self.time()
+                print(f"\n\ntime: {t:5.3f}\npid output: {output:5.3f}\n{self.voltages}")
         if verbose:
             self.save_data()
 
@@ -197,43 +361,52 @@ class Board(object):
         It saves the voltages recorded through the whole process
         """
         if name is None:
-            tmp = (str(int(time.time())), str(self.pid.tunings), str(self.pid.setpoint))
+            tmp = (str(int(time.time())), str(self.pid_tunings), str(self.pid_setpoint))
             name = "../data/%s_PID_%s_setpoint_%s.csv" % tmp
-        df = pd.DataFrame(self.voltages_history)
-        print(df)
-        df.to_csv(name)
+        print(self.voltages_history)
+        np.savetxt(
+            name,
+            np.column_stack(
+                (self._hist_time[: self._hist_n], self._hist_volts[: self._hist_n])
+            ),
+            fmt="%.6f",
+            delimiter=",",
+            header="time,vload,vin",
+            comments="",
+        )
 
     def set_current(self, current, verbose=True):
         """
         It sets a current to test a power supply
 
         :param current:     current in amps
-        :param test_time:   test_time in seconds
+        :param verbose:     print the voltage/current set
         """
         voltage_to_set = current * self.resistance
-        print("setting the following voltage: " + str(voltage_to_set))
+        if verbose:
+            print("setting the following voltage: " + str(voltage_to_set))
         self.set_vload(voltage_to_set)
-        vload = self.voltages["vload"]
-        tmp = (vload, vload / self.resistance)
-        print("voltage set: %5.3f  current set: %5.3f" % tmp)
+        if verbose:
+            vload = self.voltages.vload
+            tmp = (vload, vload / self.resistance)
+            print("voltage set: %5.3f  current set: %5.3f" % tmp)
 
     def search_current_limit(self, iend, istart=0.001, isteps=100):
         """
         It tries different currents
         """
         print("doing a current limit search")
-        points = np.linspace(istart, iend, num=isteps)
-
-        data = []
-        for i, s in enumerate(points):
-            print("i: %d:  step: %5.3f" % (i, s))
-            self.set_current(s, verbose=False)
-            datav = {}
-            datav["i"] = i
-            datav["vin"] = self.voltages["vin"]
-            datav["vload"] = self.voltages["vload"]
-            datav["current"] = self.voltages["vload"] / self.resistance
-            data.append(datav)
+        currents = np.linspace(istart, iend, num=isteps, dtype=np.float32)
+        voltages_to_set = currents * self.resistance
+
+        data = np.empty(
+            isteps,
+            dtype=[("i", "i4"), ("vin", "f4"), ("vload", "f4"), ("current", "f4")],
+        )
+        for i, vset in enumerate(voltages_to_set.tolist()):
+            self.set_vload(vset)
+            v = self.voltages
+            data[i] = (i, v.vin, v.vload, v.vload / self.resistance)
 
         df = pd.DataFrame(data)
         print(df)
@@ -252,7 +425,7 @@ class Board(object):
 
         tstart = time.time()
         while (time.time() - tstart) < test_time:
-            current_to_set = self.voltages["vin"] / resistance
+            current_to_set = self.voltages.vin / resistance
             voltage_to_set = current_to_set * self.resistance
             self.set_vload(voltage_to_set)
         self.save_data()
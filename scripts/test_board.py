@@ -5,7 +5,12 @@ Pytest unit test for board.py
 @author: Eduardo Munoz
 @email: edmugu@protonmail.com
 """
-from board import Board
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from board import Board, pid_step
 
 
 def test_board():
@@ -17,3 +22,94 @@ def test_print():
     b = Board()
     b.print()
     assert True
+
+
+def test_board_connects_lazily(monkeypatch):
+    calls = []
+
+    def fake_connect(self):
+        calls.append(self)
+        self._board = object()
+        self._pin_vload = SimpleNamespace(value=0.5)
+        self._pin_vin = SimpleNamespace(value=0.25)
+
+    monkeypatch.setattr(Board, "_connect", fake_connect)
+
+    b = Board()
+    b.print()
+    assert calls == []
+
+    b.read_voltages()
+    assert calls == [b]
+    b.read_voltages()
+    assert calls == [b]
+
+
+@pytest.mark.parametrize("sampling_interval", [0, -1, 2.5, 16384, True])
+def test_bad_sampling_interval(sampling_interval):
+    with pytest.raises(ValueError):
+        Board(sampling_interval=sampling_interval)
+
+
+@pytest.mark.parametrize("pid_gains", [(0.1, 0.2), (0.1, 0.2, 0.3, 0.4), 0.1, "abc"])
+def test_bad_pid_gains(pid_gains):
+    with pytest.raises(ValueError):
+        Board(pid_gains=pid_gains)
+
+
+def test_pid_gains():
+    b = Board(pid_gains=[1, 2, 3])
+    assert b.pid_tunings == (1.0, 2.0, 3.0)
+
+
+def test_voltages_history_grows():
+    b = Board()
+    rows = 1500  # more than the initial capacity of the history
+    times = [0.001 * i for i in range(rows)]
+    vloads = [1.0 + 0.001 * i for i in range(rows)]
+    vins = [4.0] * rows
+    b._push_history(times[:700], vloads[:700], vins[:700])
+    b._push_history(times[700:], vloads[700:], vins[700:])
+
+    df = b.voltages_history
+    assert list(df.columns) == ["time", "vload", "vin"]
+    assert len(df) == rows
+    assert df["time"].tolist() == pytest.approx(times)
+    assert df["vload"].tolist() == pytest.approx(vloads)
+    assert df["vin"].tolist() == pytest.approx(vins)
+
+
+def test_save_data(tmp_path):
+    b = Board()
+    b._push_history([0.0, 0.5, 1.0], [1.0, 1.5, 2.0], [4.0, 4.0, 4.5])
+    name = tmp_path / "data.csv"
+    b.save_data(str(name))
+
+    assert name.read_text().splitlines()[0] == "time,vload,vin"
+    df = pd.read_csv(name)
+    assert list(df.columns) == ["time", "vload", "vin"]
+    assert df["vload"].tolist() == pytest.approx([1.0, 1.5, 2.0])
+    assert df["vin"].tolist() == pytest.approx([4.0, 4.0, 4.5])
+
+
+def test_pid_step_matches_simple_pid():
+    from simple_pid import PID
+
+    kp, ki, kd = 0.05, 0.3, 0.001
+    setpoint = 2.0
+    lo, hi = 0.0, 0.52
+    pid = PID(kp, ki, kd, setpoint, sample_time=None, output_limits=(lo, hi))
+
+    integral = 0.0
+    last_input = None
+    reads = [(0.0, 0.01), (0.4, 0.012), (1.1, 0.009), (1.8, 0.011), (2.3, 0.01)]
+    reads += [(2.05, 0.02), (1.97, 0.01), (5.0, 0.01), (0.0, 0.01), (2.0, 0.01)]
+    for measurement, dt in reads:
+        expected = pid(measurement, dt=dt)
+        if last_input is None:
+            last_input = measurement
+        output, integral = pid_step(
+            kp, ki, kd, setpoint, last_input, integral, dt, measurement, lo, hi
+        )
+        last_input = measurement
+        assert output == pytest.approx(expected)